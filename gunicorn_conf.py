@@ -0,0 +1,40 @@
+"""
+Gunicorn settings for the web frontend:
+
+    gunicorn -c gunicorn_conf.py web_app:app
+
+Requests are spread over threaded workers, while transcription goes to a
+single GPU-resident Transkun server (transkun_worker.py) shared through a
+UNIX socket, so the model is loaded into GPU memory only once.
+"""
+import os
+import subprocess
+import sys
+
+TRANSKUN_SOCKET = '/tmp/transkun.sock'
+
+worker_class = 'gthread'
+workers = 2
+threads = 4
+# Transcribing a long recording can take minutes
+timeout = 600
+raw_env = [f'TRANSKUN_SOCKET={TRANSKUN_SOCKET}']
+
+_transkun_server = None
+
+
+def on_starting(server):
+    global _transkun_server
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transkun_worker.py')
+    _transkun_server = subprocess.Popen([sys.executable, script, TRANSKUN_SOCKET])
+
+
+def post_worker_init(worker):
+    import web_app
+    web_app.start_warm_up()
+
+
+def on_exit(server):
+    if _transkun_server is not None:
+        _transkun_server.terminate()
+        _transkun_server.wait()
@@ -1,24 +1,42 @@
 #!/usr/bin/env python3
 import base64
-import io
+import multiprocessing
 import os
 import sys
 import tempfile
-import cgi
+import threading
 import json
 import traceback
-import pretty_midi
+from urllib.parse import parse_qs
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from final import (
-    download_audio_from_url,
-    audio_to_polyphonic_midi,
-    infer_tonic_name,
-    convert_to_mode,
+    url_to_polyphonic_midi,
+    convert_midi_bytes,
+    MODE_DELTA,
     ensure_mid_extension,
 )
+import final_fast
+from transkun_worker import get_worker, transcribe
+
+
+def _warm() -> None:
+    final_fast.warm_up()
+    get_worker()
+
+
+# Runs once per container; warm invocations reuse the compiled scanner and
+# any resident Transkun worker. Spawned children (e.g. the Transkun worker)
+# re-import the main module before parent_process() is set, so check the
+# process name instead.
+if multiprocessing.current_process().name == 'MainProcess':
+    threading.Thread(target=_warm, daemon=True).start()
 
 def handler(event, context):
+    temp_mid = None
     try:
         content_type = event['headers'].get('content-type') or event['headers'].get('Content-Type')
         if not content_type:
@@ -32,47 +50,71 @@ def handler(event, context):
             body_bytes = base64.b64decode(body)
         else:
             body_bytes = body.encode()
-        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body_bytes))}
-        fs = cgi.FieldStorage(fp=io.BytesIO(body_bytes), environ=environ, keep_blank_values=True)
-        mode = fs.getfirst('mode', 'aeolian')
-        outname = ensure_mid_extension(fs.getfirst('out', 'output.mid'))
-        url = fs.getfirst('url', '').strip()
-        file_item = fs['midi'] if 'midi' in fs else None
-        if file_item is not None and file_item.filename:
-            temp_mid = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
-            temp_mid.write(file_item.file.read())
-            temp_mid.close()
+        temp_mid = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
+        temp_mid.close()
+        media_type = content_type.split(';', 1)[0].strip().lower()
+        if media_type == 'multipart/form-data':
+            # The uploaded MIDI is written straight to temp_mid while parsing
+            parser = StreamingFormDataParser(headers={'Content-Type': content_type})
+            midi_target = FileTarget(temp_mid.name)
+            targets = {name: ValueTarget() for name in ('mode', 'out', 'url')}
+            parser.register('midi', midi_target)
+            for name, target in targets.items():
+                parser.register(name, target)
+            try:
+                parser.data_received(body_bytes)
+            except ParseFailedException:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Access-Control-Allow-Origin': '*'},
+                    'body': 'Malformed multipart body'
+                }
+            fields = {name: target.value.decode() for name, target in targets.items()}
+            uploaded = bool(midi_target.multipart_filename)
+        elif media_type == 'application/x-www-form-urlencoded':
+            # URL-only form; there is no file to upload
+            query = parse_qs(body_bytes.decode(), keep_blank_values=True)
+            fields = {name: query.get(name, [''])[0] for name in ('mode', 'out', 'url')}
+            uploaded = False
+        else:
+            return {
+                'statusCode': 400,
+                'headers': {'Access-Control-Allow-Origin': '*'},
+                'body': f'Unsupported Content-Type: {media_type}'
+            }
+        mode = fields['mode'] or 'aeolian'
+        outname = ensure_mid_extension(fields['out'] or 'output.mid')
+        url = fields['url'].strip()
+        # Reject bad modes before spending time on download and transcription
+        if mode not in MODE_DELTA:
+            return {
+                'statusCode': 400,
+                'headers': {'Access-Control-Allow-Origin': '*'},
+                'body': f'Unsupported mode: {mode}'
+            }
+        if uploaded:
             src_mid = temp_mid.name
         elif url:
-            audio_path = download_audio_from_url(url)
-            temp_mid = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
-            temp_mid.close()
-            audio_to_polyphonic_midi(audio_path, temp_mid.name)
+            url_to_polyphonic_midi(url, temp_mid.name, transcribe)
             src_mid = temp_mid.name
-            os.remove(audio_path)
         else:
             return {
                 'statusCode': 400,
                 'headers': {'Access-Control-Allow-Origin': '*'},
                 'body': 'No input provided'
             }
-        pm = pretty_midi.PrettyMIDI(src_mid)
-        tonic_pc = pretty_midi.note_name_to_number(infer_tonic_name(pm)) % 12
-        convert_to_mode(pm, tonic_pc, mode)
-        out_path = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
-        out_path.close()
-        pm.write(out_path.name)
-        with open(out_path.name, 'rb') as f:
-            out_data = f.read()
+        with open(src_mid, 'rb') as f:
+            data = convert_midi_bytes(f.read(), mode)
         return {
             'statusCode': 200,
             'headers': {
                 'Content-Type': 'application/octet-stream',
                 'Content-Disposition': f'attachment; filename="{outname}"',
+                'Cache-Control': 'public, max-age=86400, immutable',
                 'Access-Control-Allow-Origin': '*'
             },
             'isBase64Encoded': True,
-            'body': base64.b64encode(out_data).decode()
+            'body': base64.b64encode(data).decode('ascii')
         }
     except Exception as e:
         print("Conversion error:", str(e))
@@ -82,4 +124,8 @@ def handler(event, context):
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': str(e)
         }
+    finally:
+        # Warm containers keep /tmp, so never leave the upload behind
+        if temp_mid is not None:
+            os.remove(temp_mid.name)
 
@@ -0,0 +1,110 @@
+import io
+
+import mido
+import numpy as np
+
+import final_fast
+
+
+def _smf(track: bytes) -> bytearray:
+    header = b'MThd' + (6).to_bytes(4, 'big') + bytes.fromhex('0000 0001 0060')
+    return bytearray(header + b'MTrk' + len(track).to_bytes(4, 'big') + track)
+
+
+def test_running_status_survives_meta_event():
+    # note_on, set_tempo meta, then a running-status note_on (velocity 0)
+    data = _smf(bytes.fromhex('00903c40 00ff510307a120 103c00 00ff2f00'))
+    expected = [msg.note for msg in mido.MidiFile(file=io.BytesIO(bytes(data))).tracks[0]
+                if msg.type == 'note_on' and msg.velocity > 0]
+    assert final_fast.sounded_pitches(data).tolist() == expected == [60]
+
+    final_fast.shift_notes(data, 0, np.full(12, 1, dtype=np.int8))
+    notes = [msg.note for msg in mido.MidiFile(file=io.BytesIO(bytes(data))).tracks[0]
+             if msg.type == 'note_on']
+    assert notes == [61, 61]
+
+
+def _midi_bytes(*tracks: list) -> bytearray:
+    mf = mido.MidiFile(type=1 if len(tracks) > 1 else 0)
+    for messages in tracks:
+        mf.tracks.append(mido.MidiTrack(messages + [mido.MetaMessage('end_of_track', time=0)]))
+    buf = io.BytesIO()
+    mf.save(file=buf)
+    return bytearray(buf.getvalue())
+
+
+def _timeline(data: bytearray, drop_key_signatures: bool = False) -> list:
+    """Per track, (absolute tick, message) for each event, as mido reads it."""
+    tracks = []
+    for track in mido.MidiFile(file=io.BytesIO(bytes(data))).tracks:
+        events = []
+        for msg, tick in zip(track, np.cumsum([msg.time for msg in track]).tolist()):
+            if not (drop_key_signatures and msg.type == 'key_signature'):
+                events.append((tick, msg.copy(time=0)))
+        tracks.append(events)
+    return tracks
+
+
+def _assert_key_signatures_dropped(data: bytearray) -> None:
+    expected = _timeline(data, drop_key_signatures=True)
+    final_fast.shift_notes(data, 0, np.zeros(12, dtype=np.int8), drop_key_signatures=True)
+    assert _timeline(data) == expected
+
+
+def test_consecutive_key_signatures_are_dropped():
+    _assert_key_signatures_dropped(_midi_bytes([
+        mido.Message('note_on', note=60, velocity=64, time=0),
+        mido.MetaMessage('key_signature', key='C', time=10),
+        mido.MetaMessage('key_signature', key='G', time=20),
+        mido.MetaMessage('key_signature', key='D', time=0),
+        mido.Message('note_off', note=60, time=30),
+    ]))
+
+
+def test_dropped_key_signature_delta_grows_vlq():
+    # 100 + 100 ticks no longer fits in a one-byte delta time
+    data = _midi_bytes([
+        mido.Message('note_on', note=60, velocity=64, time=0),
+        mido.MetaMessage('key_signature', key='C', time=100),
+        mido.Message('note_off', note=60, time=100),
+    ])
+    size = len(data)
+    _assert_key_signatures_dropped(data)
+    # delta + FF 59 02 sf mi (6 bytes) gone, the next delta one byte longer
+    assert len(data) == size - 6 + 1
+
+
+def test_key_signatures_dropped_from_every_track():
+    _assert_key_signatures_dropped(_midi_bytes(
+        [
+            mido.MetaMessage('key_signature', key='A', time=0),
+            mido.MetaMessage('set_tempo', tempo=500000, time=5),
+        ],
+        [
+            mido.MetaMessage('key_signature', key='E', time=0),
+            mido.Message('note_on', note=64, velocity=64, time=0),
+            mido.MetaMessage('key_signature', key='F', time=200),
+            mido.Message('note_off', note=64, time=48),
+        ],
+        [
+            mido.Message('note_on', note=67, velocity=64, time=0),
+            mido.Message('note_off', note=67, time=96),
+            mido.MetaMessage('key_signature', key='Bb', time=0),
+        ],
+    ))
+
+
+def test_ionian_keeps_key_signatures():
+    import final
+
+    data = _midi_bytes([
+        mido.MetaMessage('key_signature', key='C', time=0),
+        mido.Message('note_on', note=64, velocity=64, time=0),
+        mido.Message('note_off', note=64, time=96),
+    ])
+    original = bytes(data)
+    final.convert_to_mode(data, 0, 'ionian')
+    assert bytes(data) == original
+    final.convert_to_mode(data, 0, 'aeolian')
+    assert not any(msg.type == 'key_signature'
+                   for msg in mido.MidiFile(file=io.BytesIO(bytes(data))).tracks[0])
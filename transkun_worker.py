@@ -0,0 +1,282 @@
+"""
+transkun_worker.py
+
+Keeps a single Transkun model resident on the GPU in a background process so
+that web requests do not pay the PyTorch import and checkpoint load on every
+transcription. When CUDA is not available the `transkun` CLI is used instead,
+exactly as before.
+
+Several server processes (e.g. gunicorn workers) can share one GPU model by
+running this module as an inference server on a UNIX socket and setting
+TRANSKUN_SOCKET to its path in the workers' environment.
+
+Usage:
+    from transkun_worker import transcribe
+    transcribe('song.mp3', 'song.mid')
+
+    # Shared inference server
+    python transkun_worker.py /tmp/transkun.sock
+"""
+import atexit
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from importlib import resources
+
+# Longest a single transcription may run (not counting time spent queued
+# behind other jobs) before the worker is presumed hung
+TRANSCRIBE_TIMEOUT = 30 * 60
+# Seconds to wait for the shared inference server to accept a connection
+SOCKET_CONNECT_TIMEOUT = 5
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _load_model(device: str):
+    """Load the pretrained Transkun checkpoint the same way its CLI does."""
+    import moduleconf
+    import torch
+
+    pretrained = resources.files('transkun') / 'pretrained'
+    conf_manager = moduleconf.parseFromFile(str(pretrained / '2.0.conf'))
+    TransKun = conf_manager['Model'].module.TransKun
+    checkpoint = torch.load(str(pretrained / '2.0.pt'), map_location=device)
+    model = TransKun(conf=conf_manager['Model'].config).to(device)
+    state = checkpoint.get('best_state_dict', checkpoint.get('state_dict'))
+    model.load_state_dict(state, strict=False)
+    model.eval()
+    return model
+
+
+def _serve(device: str, requests, results) -> None:
+    """Worker process loop: transcribe (job, in_path, out_path) until None.
+
+    Reports (job, 'started', None) when a job is taken off the queue and
+    (job, 'done', error) when it finishes.
+    """
+    import torch
+    from transkun.Data import writeMidi
+    from transkun.transcribe import readAudio
+
+    torch.set_grad_enabled(False)
+    # Load the checkpoint in the background so that, if a job arrives before
+    # loading has finished, its audio is read and decoded meanwhile. This only
+    # helps the first job on a cold worker; with the startup warm-up the model
+    # is usually loaded before any request comes in.
+    loading = ThreadPoolExecutor(max_workers=1).submit(_load_model, device)
+    model = None
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        job, in_path, out_path = item
+        results.put((job, 'started', None))
+        try:
+            fs, audio = readAudio(in_path)
+            if model is None:
+                model = loading.result()
+            if fs != model.fs:
+                import soxr
+                audio = soxr.resample(audio, fs, model.fs)
+            x = torch.from_numpy(audio).to(device)
+            notes = model.transcribe(x, discardSecondHalf=False)
+            writeMidi(notes).write(out_path)
+            results.put((job, 'done', None))
+        except Exception as e:
+            results.put((job, 'done', f"{type(e).__name__}: {e}"))
+
+
+class TranskunWorker:
+    """Handle to a resident Transkun process; safe to share between threads."""
+
+    def __init__(self, device: str = 'cuda'):
+        # CUDA cannot be re-initialised in a forked child, so always spawn.
+        ctx = mp.get_context('spawn')
+        self._requests = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=_serve, args=(device, self._requests, self._results), daemon=True
+        )
+        self._process.start()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        # (job, time.monotonic() at start) of the job the process is running
+        self._running = None
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _collect(self) -> None:
+        while True:
+            try:
+                job, status, error = self._results.get(timeout=1)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    self._fail_pending()
+                    return
+                self._check_running()
+                continue
+            if status == 'started':
+                self._running = (job, time.monotonic())
+                continue
+            self._running = None
+            with self._lock:
+                future = self._pending.pop(job, None)
+            if future is None:
+                continue  # already failed by _check_running
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(RuntimeError(f"Transkun failed: {error}"))
+
+    def _check_running(self) -> None:
+        """Kill the process if the job it is running has overrun.
+
+        Jobs run one at a time, so only the running job is timed; jobs
+        waiting behind it are failed by _fail_pending once the process exits
+        and get_worker() (or the socket server) starts a fresh one.
+        """
+        running = self._running
+        if running is None or time.monotonic() - running[1] <= TRANSCRIBE_TIMEOUT:
+            return
+        self._running = None
+        self._process.kill()
+        with self._lock:
+            future = self._pending.pop(running[0], None)
+        if future is not None:
+            future.set_exception(RuntimeError("Transkun worker timed out."))
+
+    def _fail_pending(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("Transkun worker process exited."))
+
+    def transcribe(self, input_audio: str, output_midi: str) -> None:
+        if not self._process.is_alive():
+            raise RuntimeError("Transkun worker process is not running.")
+        future = Future()
+        with self._lock:
+            job = next(self._ids)
+            self._pending[job] = future
+        self._requests.put((job, input_audio, output_midi))
+        # _collect enforces TRANSCRIBE_TIMEOUT once the job has started
+        future.result()
+
+    def is_alive(self) -> bool:
+        return self._process.is_alive()
+
+    def close(self) -> None:
+        self._requests.put(None)
+        self._process.join(timeout=5)
+
+
+class WorkerUnavailable(RuntimeError):
+    """Raised when the shared inference server cannot be reached."""
+
+
+class SocketWorker:
+    """Client for a TranskunWorker served over a UNIX socket by serve()."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def transcribe(self, input_audio: str, output_midi: str) -> None:
+        request = {'input': os.path.abspath(input_audio), 'output': os.path.abspath(output_midi)}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(SOCKET_CONNECT_TIMEOUT)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                # e.g. a stale socket file left by a server that has exited
+                raise WorkerUnavailable(f"Cannot reach Transkun server: {e}") from e
+            # The server times the job once it starts running; waiting in its
+            # queue behind other jobs must not count against the request.
+            sock.settimeout(None)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            reply = json.loads(sock.makefile('rb').readline() or b'{"error": "no reply"}')
+        if reply['error']:
+            raise RuntimeError(reply['error'])
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        request = json.loads(self.rfile.readline())
+        with self.server.worker_lock:
+            # Replace a worker that was killed after a timeout
+            if not self.server.worker.is_alive():
+                self.server.worker = TranskunWorker('cuda')
+            worker = self.server.worker
+        try:
+            worker.transcribe(request['input'], request['output'])
+            error = None
+        except Exception as e:
+            error = str(e)
+        self.wfile.write(json.dumps({'error': error}).encode() + b'\n')
+
+
+def serve(path: str) -> None:
+    """Serve one resident GPU model to every process connecting on `path`."""
+    import torch
+    if not torch.cuda.is_available():
+        print("No CUDA device; not starting the Transkun server.", file=sys.stderr)
+        return
+    # Turn SIGTERM into SystemExit so the socket file is cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.path.exists(path):
+        os.remove(path)
+    with socketserver.ThreadingUnixStreamServer(path, _RequestHandler) as server:
+        # Connections are handled on threads and queue up on the one model
+        server.worker = TranskunWorker('cuda')
+        server.worker_lock = threading.Lock()
+        try:
+            server.serve_forever()
+        finally:
+            server.worker.close()
+            os.remove(path)
+
+
+def get_worker():
+    """Return the shared GPU worker, or None if CUDA/Transkun are unavailable."""
+    global _worker
+    socket_path = os.environ.get('TRANSKUN_SOCKET')
+    if socket_path:
+        # The server only creates its socket when a GPU is available
+        return SocketWorker(socket_path) if os.path.exists(socket_path) else None
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            try:
+                import torch
+            except ImportError:
+                return None
+            if not torch.cuda.is_available():
+                return None
+            _worker = TranskunWorker('cuda')
+            atexit.register(_worker.close)
+        return _worker
+
+
+def transcribe(input_audio: str, output_midi: str) -> None:
+    """Transcribe with the resident GPU model, falling back to the CLI."""
+    worker = get_worker()
+    if worker is not None:
+        try:
+            worker.transcribe(input_audio, output_midi)
+            return
+        except WorkerUnavailable:
+            pass
+    subprocess.run(['transkun', input_audio, output_midi], check=True)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
@@ -1,48 +1,72 @@
-from flask import Flask, request, send_file
-import tempfile
+from flask import Flask, Response, request, send_file
+import io
 import os
-import pretty_midi
+import tempfile
+import threading
 from final import (
-    download_audio_from_url,
-    audio_to_polyphonic_midi,
-    infer_tonic_name,
-    convert_to_mode,
+    url_to_polyphonic_midi,
+    convert_midi_bytes,
+    MODE_DELTA,
     ensure_mid_extension,
 )
+import final_fast
+from transkun_worker import get_worker, transcribe
 
 app = Flask(__name__)
 
-HTML_PAGE = open('index.html', 'r').read()
+
+def _warm() -> None:
+    """Pay one-off start-up costs before the first request needs them."""
+    final_fast.warm_up()
+    get_worker()  # spawns the GPU worker, which loads the model in the background
+
+
+def start_warm_up() -> None:
+    """Warm up in the background; call from the serving process only.
+
+    Not run at import: the spawned Transkun worker re-imports this module as
+    __mp_main__ and must not warm up (and try to spawn a worker) itself.
+    """
+    threading.Thread(target=_warm, daemon=True).start()
+
+# The page is static, so keep it as encoded bytes rather than re-encoding a
+# str on every request. Response sets Content-Length from the bytes body.
+with open('index.html', 'rb') as f:
+    HTML_BYTES = f.read()
 
 @app.route('/')
 def index():
-    return HTML_PAGE
+    return Response(HTML_BYTES, mimetype='text/html',
+                    headers={'Cache-Control': 'public, max-age=3600'})
 
 @app.route('/convert', methods=['POST'])
 def convert():
     mode = request.form.get('mode', 'aeolian')
     outname = ensure_mid_extension(request.form.get('out', 'output.mid'))
     url = request.form.get('url', '').strip()
+    # Reject bad modes before spending time on download and transcription
+    if mode not in MODE_DELTA:
+        return f'Unsupported mode: {mode}', 400
     midi_file = request.files.get('midi')
     if midi_file and midi_file.filename:
-        tmp_mid = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
-        midi_file.save(tmp_mid.name)
-        src_mid = tmp_mid.name
+        data = midi_file.read()
     elif url:
-        audio_path = download_audio_from_url(url)
         tmp_mid = tempfile.NamedTemporaryFile(suffix='.mid', delete=False)
-        audio_to_polyphonic_midi(audio_path, tmp_mid.name)
-        src_mid = tmp_mid.name
-        os.remove(audio_path)
+        tmp_mid.close()
+        try:
+            url_to_polyphonic_midi(url, tmp_mid.name, transcribe)
+            with open(tmp_mid.name, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(tmp_mid.name)
     else:
         return 'No input provided', 400
 
-    pm = pretty_midi.PrettyMIDI(src_mid)
-    tonic_pc = pretty_midi.note_name_to_number(infer_tonic_name(pm)) % 12
-    convert_to_mode(pm, tonic_pc, mode)
-    out_path = tempfile.NamedTemporaryFile(suffix='.mid', delete=False).name
-    pm.write(out_path)
-    return send_file(out_path, as_attachment=True, download_name=outname)
+    # The output is fully determined by (input bytes, mode)
+    response = send_file(io.BytesIO(convert_midi_bytes(data, mode)), mimetype='audio/midi',
+                         as_attachment=True, download_name=outname)
+    response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response
 
 # Netlify expects the serverless function under '/.netlify/functions/convert'.
 # When running this Flask app locally, the HTML still posts to that path, so we
@@ -52,4 +76,5 @@ def convert_netlify():
     return convert()
 
 if __name__ == '__main__':
+    start_warm_up()
     app.run()